@@ -1,85 +1,32 @@
 import streamlit as st
-from docxtpl import DocxTemplate
-import tempfile
-import datetime
+import io
 import os
-import smtplib
-from email.message import EmailMessage
-
-# --- Helper: generate letter ---
-def generate_letter(template_path, context):
-    doc = DocxTemplate(template_path)
-    doc.render(context)
-    return doc
-
-
-# --- Save DOCX only ---
-def save_docx_only(doc, student_name, university_name):
-    temp_dir = tempfile.mkdtemp()
-    safe_student = student_name.replace(" ", "_").replace("/", "_")
-    safe_univ = university_name.replace(" ", "_").replace("/", "_")
-    base = f"{safe_student}_{safe_univ}"
-    docx_path = os.path.join(temp_dir, f"{base}.docx")
-    doc.save(docx_path)
-    return docx_path
-
-
-# --- Send email via Gmail SMTP ---
-def send_email_with_gmail(full_name, university, grad_class, cwa, phone, docx_path):
-    """Send the generated letter to your Gmail using SMTP."""
-    sender = st.secrets["SMTP_EMAIL"]
-    password = st.secrets["SMTP_PASS"]
-    recipient = st.secrets["SMTP_EMAIL"]  # send to yourself
-
-    # Create the email
-    msg = EmailMessage()
-    msg["From"] = sender
-    msg["To"] = recipient
-    msg["Subject"] = f"Recommendation Letter Request: {full_name} ({university})"
-    msg.set_content(
-        f"""Dear Dr. Kwegyir,
-
-A new recommendation letter request has been submitted.
-
-Student Details:
-----------------
-Name: {full_name}
-University: {university}
-Graduating Class: {grad_class}
-CWA: {cwa}
-Phone: {phone}
-
-The generated Word document is attached.
-
-Kind regards,
-Automated Recommendation Letter System
-"""
-    )
-
-    # Attach the Word file
-    with open(docx_path, "rb") as f:
-        file_data = f.read()
-        file_name = os.path.basename(docx_path)
-        msg.add_attachment(
-            file_data,
-            maintype="application",
-            subtype="vnd.openxmlformats-officedocument.wordprocessingml.document",
-            filename=file_name,
-        )
-
-    # Send via Gmail SMTP
-    try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as smtp:
-            smtp.login(sender, password)
-            smtp.send_message(msg)
-        st.success("✅ Your recommendation letter request has been sent successfully to the Lecturer.")
-    except Exception as e:
-        st.error(f"❌ Email sending failed: {e}")
-
+import zipfile
+
+from letter_core import (
+    BULK_COLUMNS,
+    build_context,
+    build_docx,
+    convert_pending_to_pdf,
+    docx_filename,
+    prewarm,
+    render_bulk,
+    save_and_convert_to_pdf,
+    send_email_with_gmail,
+    template_diagnostics,
+    template_exists,
+    template_fingerprint,
+    template_for,
+    worker_pool,
+)
 
 # --- Streamlit UI ---
 st.set_page_config(page_title="Graduate Recommendation Letter Submission", layout="wide")
 
+# Warm templates, Jinja env and the PDF engine chain while the user is
+# still filling in the form, so the first submission runs at steady state.
+prewarm()
+
 # --- Hide Streamlit default UI elements ---
 hide_streamlit_style = """
     <style>
@@ -97,26 +44,38 @@ st.markdown(hide_streamlit_style, unsafe_allow_html=True)
 st.title("Graduate School Recommendation Letter Request Submission Form")
 
 st.markdown("""
-Please complete this form accurately.  
+Please complete this form accurately.
 """)
 
+# --- Startup template check: flag images pandoc's LaTeX path can't embed ---
+for _template in ("Letter.docx", "Male.docx", "Female.docx"):
+    if template_exists(_template):
+        _bad_media = template_diagnostics(_template, template_fingerprint(_template))
+        if _bad_media:
+            st.warning(
+                f"⚠️ Template '{_template}' contains EMF/WMF images "
+                f"({', '.join(_bad_media)}). PDF conversion will need "
+                "LibreOffice; the pandoc fallback cannot embed them."
+            )
+
 # --- Input Form ---
 with st.form("recommendation_form"):
     st.subheader("🧾 Student Details")
 
     col1, col2 = st.columns(2)
     with col1:
-        full_name = st.text_input("Full Name of Student", placeholder="e.g., Jane Doe")
+        full_name = st.text_input("Full Name of Student", placeholder="e.g., Jane Doe", max_chars=100)
         gender = st.selectbox("Gender", ["Male", "Female"])
-        university = st.text_input("University Applying To", placeholder="e.g., Stanford University")
-        phone = st.text_input("Phone Number", placeholder="e.g., +233 24 123 4567")
+        university = st.text_input("University Applying To", placeholder="e.g., Stanford University", max_chars=150)
+        phone = st.text_input("Phone Number", placeholder="e.g., +233 24 123 4567", max_chars=30)
 
     with col2:
-        project_topic = st.text_input("Final Year Project Topic", placeholder="e.g., AI in Renewable Energy")
-        grad_class = st.text_input("Graduating Class", placeholder="e.g., First Class Honours")
-        cwa = st.text_input("Cumulative Weighted Average (CWA)", placeholder="e.g., 78.5%")
-        year = st.text_input("Year Lecturer Began Teaching You", placeholder="e.g., 2021")
+        project_topic = st.text_input("Final Year Project Topic", placeholder="e.g., AI in Renewable Energy", max_chars=250)
+        grad_class = st.text_input("Graduating Class", placeholder="e.g., First Class Honours", max_chars=60)
+        cwa = st.text_input("Cumulative Weighted Average (CWA)", placeholder="e.g., 78.5%", max_chars=20)
+        year = st.text_input("Year Lecturer Began Teaching You", placeholder="e.g., 2021", max_chars=10)
 
+    want_pdf = st.checkbox("Also generate a PDF copy", value=False)
     submitted = st.form_submit_button("Submit Request")
 
 # --- Processing ---
@@ -127,27 +86,118 @@ if submitted:
     else:
         with st.spinner("⏳ Generating and sending letter..."):
             try:
-                current_date = datetime.date.today().strftime("%B %d, %Y")
-                context = {
-                    "Name": full_name,
-                    "Name_Upper": full_name.upper(),
-                    "University_Applying_To": university,
-                    "Project_Topic": project_topic,
-                    "Graduating_Class": grad_class,
-                    "CWA": cwa,
-                    "Year": year,
-                    "Date": current_date,
-                }
+                context = build_context(full_name, gender, university, project_topic, grad_class, cwa, year)
 
                 # Select the appropriate template
-                template_file = "Male.docx" if gender == "Male" else "Female.docx"
+                template_file = template_for(gender)
 
-                if not os.path.exists(template_file):
+                if not template_exists(template_file):
                     st.error(f"❌ Template file '{template_file}' not found.")
                 else:
-                    doc = generate_letter(template_file, context)
-                    docx_path = save_docx_only(doc, full_name, university)
-                    send_email_with_gmail(full_name, university, grad_class, cwa, phone, docx_path)
+                    docx_bytes = build_docx(
+                        template_file,
+                        template_fingerprint(template_file),
+                        tuple(sorted(context.items())),
+                    )
+                    docx_name = docx_filename(full_name, university)
+                    st.session_state.setdefault("pending", []).append((docx_name, docx_bytes))
+
+                    # Kick the slow stages off as independent jobs so the
+                    # PDF conversion (when requested) and the SMTP send
+                    # overlap; the DOCX download is available straight away.
+                    pdf_future = (
+                        worker_pool().submit(save_and_convert_to_pdf, docx_bytes)
+                        if want_pdf
+                        else None
+                    )
+                    email_future = worker_pool().submit(
+                        send_email_with_gmail,
+                        full_name, university, grad_class, cwa, phone, docx_bytes, docx_name,
+                    )
+
+                    st.download_button(
+                        "⬇️ Download Letter (DOCX)",
+                        data=docx_bytes,
+                        file_name=docx_name,
+                    )
+
+                    try:
+                        email_future.result(timeout=120)
+                        st.success("✅ Your recommendation letter request has been sent successfully to the Lecturer.")
+                    except Exception as e:
+                        st.error(f"❌ Email sending failed: {e}")
+
+                    pdf_bytes = None
+                    if pdf_future is not None:
+                        try:
+                            pdf_bytes = pdf_future.result(timeout=120)
+                        except Exception as conv_error:
+                            st.warning(f"⚠️ PDF conversion failed: {conv_error}")
+                    if pdf_bytes:
+                        st.download_button(
+                            "⬇️ Download Letter (PDF)",
+                            data=pdf_bytes,
+                            file_name=os.path.splitext(docx_name)[0] + ".pdf",
+                        )
 
             except Exception as e:
                 st.error(f"❌ Unexpected error: {e}")
+
+# --- Bulk mode: generate letters for a whole spreadsheet of students ---
+with st.expander("📚 Bulk generate from a spreadsheet"):
+    st.caption("Expected columns: " + ", ".join(BULK_COLUMNS))
+    bulk_file = st.file_uploader("Student spreadsheet", type=["csv", "xlsx"])
+    if bulk_file is not None and st.button("📝 Generate All Letters"):
+        with st.spinner("⏳ Rendering letters..."):
+            try:
+                import pandas as pd
+
+                if bulk_file.name.lower().endswith(".csv"):
+                    df = pd.read_csv(bulk_file, dtype=str)
+                else:
+                    df = pd.read_excel(bulk_file, dtype=str)
+                missing = [col for col in BULK_COLUMNS if col not in df.columns]
+                if missing:
+                    st.error(f"❌ Spreadsheet is missing columns: {', '.join(missing)}")
+                else:
+                    letters = render_bulk(df.fillna("").to_dict("records"))
+                    st.session_state.setdefault("pending", []).extend(letters)
+                    bulk_buf = io.BytesIO()
+                    # DOCX files are zips themselves — store, don't re-deflate.
+                    with zipfile.ZipFile(bulk_buf, "w", zipfile.ZIP_STORED) as zf:
+                        for letter_name, letter_bytes in letters:
+                            zf.writestr(letter_name, letter_bytes)
+                    bulk_buf.seek(0)
+                    st.success(f"✅ Generated {len(letters)} letters.")
+                    st.download_button(
+                        "⬇️ Download All Letters (ZIP)",
+                        data=bulk_buf,
+                        file_name="recommendation_letters_docx.zip",
+                    )
+            except Exception as e:
+                st.error(f"❌ Bulk generation failed: {e}")
+
+# --- Batch mode: convert every letter from this session in one pass ---
+pending = st.session_state.get("pending", [])
+if pending:
+    st.caption(f"🗂 {len(pending)} letter(s) generated this session.")
+    if st.button("📄 Convert All to PDF"):
+        with st.spinner("⏳ Converting all letters..."):
+            try:
+                pdfs = convert_pending_to_pdf(pending)
+                zip_buf = io.BytesIO()
+                # PDFs are already compressed; deflating them again just
+                # burns CPU for a ~0% size win.
+                with zipfile.ZipFile(zip_buf, "w", zipfile.ZIP_STORED) as zf:
+                    for pdf_name, pdf_bytes in pdfs:
+                        zf.writestr(pdf_name, pdf_bytes)
+                # Hand the buffer itself to Streamlit instead of getvalue(),
+                # which would duplicate the whole archive in memory.
+                zip_buf.seek(0)
+                st.download_button(
+                    "⬇️ Download All PDFs (ZIP)",
+                    data=zip_buf,
+                    file_name="recommendation_letters.zip",
+                )
+            except Exception as e:
+                st.error(f"❌ Batch conversion failed: {e}")
@@ -0,0 +1,732 @@
+"""Core letter-generation helpers shared by the Streamlit entrypoint(s).
+
+Everything that is not UI lives here: template caching, docx rendering,
+PDF conversion (LibreOffice, WeasyPrint, one-shot pandoc) and email
+dispatch.
+"""
+
+import streamlit as st
+import atexit
+import base64
+import copy
+import functools
+import itertools
+import logging
+import time
+import io
+import shutil
+import subprocess
+import tempfile
+import datetime
+import os
+import smtplib
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+import jinja2
+import pypandoc
+import requests
+from docxtpl import DocxTemplate
+
+# Imported up front rather than inside _limit_converter_memory: that
+# function runs between fork and exec in the child of a multithreaded
+# process, where entering the import machinery can deadlock on locks
+# another thread held at fork time.
+try:
+    import resource
+except ImportError:  # non-POSIX platform
+    resource = None
+
+# Truly optional dependencies (weasyprint, pandas) stay behind lazy
+# imports in their handlers; everything on the letter hot path is
+# imported here once — sys.modules makes reruns pay only a dict lookup,
+# and pandoc itself is only probed inside the cached _ensure_pandoc().
+
+_PANDOC_SERVER_URL = "http://127.0.0.1:3030"
+
+_LOG = logging.getLogger(__name__)
+
+# File-based converters get their scratch space on tmpfs where available,
+# so their "disk" round trip is really a memory copy.
+_TMPFS_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# A rendered letter is tens of KB; anything near this cap means
+# pathological input, and pandoc is known to eat all available RAM on
+# oversized documents — refuse rather than OOM the container.
+_MAX_CONVERT_BYTES = 20 * 1024 * 1024
+
+
+def _limit_converter_memory():
+    """preexec_fn for pandoc subprocesses: cap their address space so a
+    runaway conversion dies with an error instead of taking the VM down.
+    Quietly a no-op where the resource module is unavailable; nothing
+    else may happen here — this runs in the forked child before exec."""
+    if resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (512 * 1024 * 1024, 512 * 1024 * 1024))
+
+
+# Unique basenames within the pooled scratch dir (itertools.count is
+# atomic under the GIL, so worker threads can share it).
+_scratch_seq = itertools.count()
+
+
+@st.cache_resource
+def _scratch_dir():
+    """One pooled scratch directory for every file-based conversion.
+
+    Allocating and tearing down a directory tree per conversion costs a
+    mkdir/rmdir pair of syscalls each time and, before cleanup was added,
+    leaked tempdirs; one pooled directory reaped at exit does neither."""
+    scratch = tempfile.mkdtemp(prefix="rec_", dir=_TMPFS_DIR)
+    atexit.register(shutil.rmtree, scratch, ignore_errors=True)
+    return scratch
+
+
+def _scratch_base():
+    """A fresh collision-free basename inside the pooled scratch dir."""
+    return os.path.join(_scratch_dir(), f"letter-{next(_scratch_seq)}")
+
+# Single-pass filename sanitizer: one C-level scan instead of chained
+# .replace() calls. Covers path separators plus the characters Windows
+# refuses in filenames, so downloads open cleanly everywhere.
+_SAFE_TBL = str.maketrans(dict.fromkeys(' /\\:<>"|?*', "_"))
+
+
+def safe_filename(name):
+    """Sanitize one filename component in a single translate pass."""
+    return name.translate(_SAFE_TBL)
+
+# Attachments are base64-encoded for SMTP (~33% inflation); above this
+# size the letter is left out of the email and fetched from the app
+# instead of bloating the message.
+_MAX_ATTACHMENT_BYTES = 10 * 1024 * 1024
+
+
+# --- Persistent Pandoc server ---
+@st.cache_resource
+def _pandoc_server():
+    """Start a long-running `pandoc server` once so the docx -> HTML legs
+    (WeasyPrint, batch mode) are a single HTTP round trip instead of a
+    fresh pandoc process per letter.
+
+    Server mode only does pure in-process conversions — it cannot emit
+    PDF, which needs the LaTeX shell-out it refuses — so nothing asks it
+    for PDF directly."""
+    try:
+        return subprocess.Popen(
+            ["pandoc", "server", "--port", "3030"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            preexec_fn=_limit_converter_memory,
+        )
+    except OSError:
+        return None
+
+
+@st.cache_resource
+def worker_pool():
+    """Background workers for the slow stages (PDF conversion, SMTP), so the
+    script run is not held hostage by them."""
+    return ThreadPoolExecutor(max_workers=2)
+
+
+@st.cache_resource
+def _jinja_env():
+    """One Jinja2 environment for every render; docxtpl otherwise builds a
+    fresh environment (and recompiles filters/config) per render() call.
+
+    StrictUndefined makes a placeholder typo in a template raise instead
+    of silently rendering a blank into somebody's recommendation letter —
+    build_context always supplies every field the templates use."""
+    return jinja2.Environment(
+        autoescape=False,
+        cache_size=64,
+        undefined=jinja2.StrictUndefined,
+    )
+
+
+@st.cache_resource
+def _http():
+    """One keep-alive HTTP session for all outbound calls, cached across
+    reruns so connections are reused instead of re-handshaking."""
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4))
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4))
+    return session
+
+
+@st.cache_resource
+def _soffice_path():
+    """Locate a headless-capable LibreOffice binary once."""
+    return shutil.which("soffice") or shutil.which("libreoffice")
+
+
+@st.cache_resource
+def _smtp():
+    """Warm, logged-in SMTP connection reused across submissions, so each
+    email skips the TLS handshake + AUTH round trips.
+
+    smtplib is not thread-safe and this one connection is shared by every
+    worker thread, so all use goes through _SMTP_LOCK — concurrent sends
+    would otherwise interleave their commands on the single socket."""
+    smtp = smtplib.SMTP_SSL("smtp.gmail.com", 465)
+    smtp.login(st.secrets["SMTP_EMAIL"], st.secrets["SMTP_PASS"])
+    return smtp
+
+
+# Serializes every use of the shared _smtp() connection, including the
+# clear-and-reconnect retry.
+_SMTP_LOCK = threading.Lock()
+
+
+@st.cache_resource
+def _ensure_pandoc():
+    """Locate the pandoc binary once and memoize the path.
+
+    Probing the filesystem (and possibly downloading pandoc) on every rerun
+    is wasted work, so this runs only on the first PDF request that needs
+    the one-shot fallback."""
+    try:
+        return pypandoc.get_pandoc_path()
+    except OSError:
+        pypandoc.download_pandoc()
+        return pypandoc.get_pandoc_path()
+
+
+# --- Template cache ---
+@functools.lru_cache(maxsize=8)
+def _template_stat(template_path, bucket):
+    try:
+        s = os.stat(template_path)
+    except OSError:
+        return None
+    return (s.st_mtime_ns, s.st_size)
+
+
+def _stat_template(template_path):
+    """Template stat memoized in 30-second buckets.
+
+    Templates are static assets, so hitting the filesystem on every
+    submission buys nothing; a changed or added template is still picked
+    up within half a minute."""
+    return _template_stat(template_path, int(time.monotonic()) // 30)
+
+
+def template_exists(template_path):
+    """Existence check that rides the bucketed stat cache."""
+    return _stat_template(template_path) is not None
+
+
+def template_fingerprint(template_path):
+    """Constant-time cache key for a template file: (mtime_ns, size) from
+    the bucketed stat cache. Invalidates when the file changes without
+    ever hashing its bytes."""
+    fingerprint = _stat_template(template_path)
+    if fingerprint is None:
+        raise FileNotFoundError(template_path)
+    return fingerprint
+
+
+@st.cache_resource
+def _load_template(template_path, fingerprint):
+    """Parse a template once per (path, fingerprint) and keep the
+    DocxTemplate.
+
+    Constructing a DocxTemplate is the expensive part of a render (zip +
+    XML parse); render() mutates the document in place, so callers must
+    deepcopy the cached instance instead of rendering it directly."""
+    return DocxTemplate(template_path)
+
+
+def list_docx_media(docx_path):
+    """List (name, size) of every media entry in a DOCX in one ZipFile pass.
+
+    A docx is a zip; opening it once and walking infolist() reads the
+    central directory a single time, instead of re-opening per query."""
+    with zipfile.ZipFile(docx_path) as z:
+        return [
+            (zi.filename, zi.file_size)
+            for zi in z.infolist()
+            if zi.filename.startswith("word/media/")
+        ]
+
+
+@st.cache_resource
+def template_diagnostics(template_path, fingerprint):
+    """Names of EMF/WMF media inside a template, computed once per
+    (path, fingerprint).
+
+    pandoc's LaTeX path cannot embed these formats, so finding them after
+    a failed multi-second conversion wastes a full xelatex run per submit;
+    checking at startup costs one zip-directory read."""
+    return [
+        name
+        for name, _ in list_docx_media(template_path)
+        if name.lower().endswith((".emf", ".wmf"))
+    ]
+
+
+@st.cache_resource
+def prewarm():
+    """Pay the cold-start costs once at boot instead of on the first click.
+
+    Parses both templates, builds the Jinja environment, spins up the
+    worker pool and resolves the PDF engine chain (which warm-converts a
+    probe document through every candidate engine). Any individual
+    failure is non-fatal — the lazy paths simply handle it later."""
+    for template in (_MERGED_TEMPLATE, "Male.docx", "Female.docx"):
+        try:
+            if template_exists(template):
+                _load_template(template, template_fingerprint(template))
+        except Exception:
+            pass
+    for warm in (_jinja_env, worker_pool, _pdf_engines):
+        try:
+            warm()
+        except Exception:
+            pass
+
+
+# --- Template selection ---
+# Gender-specific pronouns supplied to every render, so a single merged
+# Letter.docx using {{ Pronoun_Subj }}-style placeholders (or docxtpl
+# {%p if %} blocks on Gender) can replace the two per-gender templates
+# as a pure content change — one parse, one cache entry.
+_PRONOUNS = {
+    "Male": {"Pronoun_Subj": "he", "Pronoun_Obj": "him", "Pronoun_Poss": "his"},
+    "Female": {"Pronoun_Subj": "she", "Pronoun_Obj": "her", "Pronoun_Poss": "her"},
+}
+
+_MERGED_TEMPLATE = "Letter.docx"
+
+
+def template_for(gender):
+    """Template path to render for a gender: the merged Letter.docx when it
+    exists, else the per-gender file."""
+    if template_exists(_MERGED_TEMPLATE):
+        return _MERGED_TEMPLATE
+    return "Male.docx" if gender == "Male" else "Female.docx"
+
+
+# --- Context construction ---
+@st.cache_data(ttl=3600, show_spinner=False)
+def _today_str():
+    """Today's letter date, formatted once an hour — strftime's
+    locale-aware month lookup is the priciest part of building a context,
+    and the value only changes at midnight."""
+    return datetime.date.today().strftime("%B %d, %Y")
+
+
+def build_context(full_name, gender, university, project_topic, grad_class, cwa, year):
+    """Build the docxtpl rendering context for one student."""
+    current_date = _today_str()
+    return {
+        "Name": full_name,
+        "Name_Upper": full_name.upper(),
+        "Gender": gender,
+        "University_Applying_To": university,
+        "Project_Topic": project_topic,
+        "Graduating_Class": grad_class,
+        "CWA": cwa,
+        "Year": year,
+        "Date": current_date,
+        **_PRONOUNS.get(gender, {}),
+    }
+
+
+# --- Helper: generate letter ---
+def generate_letter(template_path, context):
+    doc = copy.deepcopy(_load_template(template_path, template_fingerprint(template_path)))
+    doc.render(context, jinja_env=_jinja_env())
+    return doc
+
+
+# --- Memoized render pipeline ---
+@st.cache_data(max_entries=256, show_spinner=False)
+def build_docx(template_path, template_fp, context_items):
+    """Render one letter to DOCX bytes, memoized on template + context.
+
+    Resubmitting the same student (the typo-fix/double-click pattern)
+    returns the cached bytes without touching docxtpl; the context comes
+    in as a tuple of items so Streamlit can hash it, and the Date field
+    inside it keeps entries from leaking across days. Together with the
+    content-hash memo on save_and_convert_to_pdf this makes the whole
+    (template, context) -> (docx, pdf) pipeline a cache lookup."""
+    doc = generate_letter(template_path, dict(context_items))
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+def docx_filename(student_name, university_name):
+    """Sanitized download/attachment filename for one letter."""
+    return f"{safe_filename(student_name)}_{safe_filename(university_name)}.docx"
+
+
+# --- Convert DOCX to PDF ---
+def _probe_docx():
+    """A minimal one-paragraph DOCX for warm-up conversions.
+
+    python-docx ships with docxtpl, so building the probe in memory costs
+    nothing extra and keeps the warm-up independent of the letter
+    templates."""
+    from docx import Document
+
+    buf = io.BytesIO()
+    doc = Document()
+    doc.add_paragraph("Warm-up probe.")
+    doc.save(buf)
+    return buf.getvalue()
+
+
+@st.cache_resource
+def _pdf_engines():
+    """Resolve the usable PDF engines once and return them in preference
+    order.
+
+    Each candidate (is soffice on PATH? is WeasyPrint importable?) must
+    then convert a one-paragraph probe document: a process that answers
+    is not a process that can convert, so candidates that fail the real
+    conversion are evicted from the chain rather than failing every
+    letter later. The probe run doubles as the warm start — LibreOffice
+    profile creation, WeasyPrint font discovery and the LaTeX format
+    caches are all paid here instead of on the first submission. The
+    Pandoc server is not an engine in its own right — it cannot emit
+    PDF — and only appears inside the WeasyPrint leg as the fast way to
+    get HTML.
+
+    LibreOffice leads the chain: its writer_pdf_Export renders the Word
+    layout (letterhead, EMF images) exactly, while every pandoc route
+    re-typesets the letter through LaTeX — slower and visibly different
+    from the DOCX the student downloads."""
+    candidates = []
+    if _soffice_path() is not None:
+        candidates.append(_soffice_convert)
+    try:
+        import weasyprint  # noqa: F401
+
+        candidates.append(_weasyprint_convert)
+    except ImportError:
+        pass
+    candidates.append(_pandoc_cli_convert)
+
+    probe = _probe_docx()
+    engines = []
+    for engine in candidates:
+        try:
+            if engine(probe):
+                engines.append(engine)
+                continue
+        except Exception as e:
+            _LOG.warning(
+                "PDF engine %s failed its warm-up conversion and is disabled: %s",
+                engine.__name__, e,
+            )
+    if engines:
+        return engines
+    # Nothing passed — keep the whole chain so a transient warm-up hiccup
+    # (server still booting, disk pressure) doesn't condemn the session.
+    _LOG.warning("No PDF engine passed warm-up; keeping the unverified chain.")
+    return candidates
+
+
+def _server_ready():
+    """True once the freshly spawned Pandoc server answers; it needs a
+    moment after Popen before it is accepting connections."""
+    for _ in range(10):
+        try:
+            _http().get(_PANDOC_SERVER_URL + "/version", timeout=2)
+            return True
+        except requests.RequestException:
+            time.sleep(0.2)
+    return False
+
+
+def _pandoc_cli_convert(docx_bytes):
+    """Last resort: one-shot pandoc invoked directly with explicit formats,
+    streaming the DOCX in on stdin and the PDF out on stdout.
+
+    Going straight to the binary skips pypandoc's format-listing probe
+    runs and keeps even this engine off the filesystem; it still drags in
+    the LaTeX toolchain, which is why it sits at the end of the chain."""
+    pandoc = _ensure_pandoc()
+    result = subprocess.run(
+        [pandoc, "--from", "docx", "--to", "pdf", "--no-highlight", "--output", "-"],
+        input=docx_bytes,
+        capture_output=True,
+        timeout=120,
+        preexec_fn=_limit_converter_memory,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(
+            result.stderr.decode(errors="replace").strip() or "pandoc conversion failed"
+        )
+    return result.stdout
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def save_and_convert_to_pdf(docx_bytes):
+    """Convert rendered DOCX bytes to PDF bytes.
+
+    Memoized on the hash of the DOCX content, so resubmitting identical
+    inputs (common with Streamlit reruns) skips the conversion entirely.
+    Walks the persistent engine chain resolved at startup; if one engine
+    dies mid-session the next one picks up the letter."""
+    if len(docx_bytes) > _MAX_CONVERT_BYTES:
+        raise ValueError(
+            f"Document is {len(docx_bytes) // (1024 * 1024)} MB; "
+            "refusing to convert anything over "
+            f"{_MAX_CONVERT_BYTES // (1024 * 1024)} MB."
+        )
+    last_error = None
+    for engine in _pdf_engines():
+        try:
+            pdf_bytes = engine(docx_bytes)
+            if pdf_bytes is not None:
+                return pdf_bytes
+        except Exception as e:
+            last_error = e
+    if last_error is not None:
+        raise last_error
+    raise RuntimeError("No PDF engine available")
+
+
+@st.cache_resource
+def _weasy_fonts():
+    """WeasyPrint font database, built once — font discovery is the slow
+    part of its start-up."""
+    from weasyprint.text.fonts import FontConfiguration
+
+    return FontConfiguration()
+
+
+def _weasyprint_convert(docx_bytes):
+    """Convert via docx → HTML → WeasyPrint, or None if WeasyPrint is not
+    installed.
+
+    These letters are mostly text, so an HTML print stays in-process and
+    avoids the LaTeX toolchain; it sits just ahead of the heavyweight
+    pandoc/LaTeX last resort in the engine chain."""
+    try:
+        import weasyprint
+    except ImportError:
+        return None
+    html = None
+    if _pandoc_server() is not None and _server_ready():
+        try:
+            response = _http().post(
+                _PANDOC_SERVER_URL,
+                json={
+                    "text": base64.b64encode(docx_bytes).decode("ascii"),
+                    "from": "docx",
+                    "to": "html",
+                    "standalone": True,
+                },
+                timeout=60,
+            )
+            response.raise_for_status()
+            html = response.text
+        except requests.RequestException:
+            pass
+    if html is None:
+        _ensure_pandoc()
+        docx_path = _scratch_base() + ".docx"
+        try:
+            with open(docx_path, "wb") as f:
+                f.write(docx_bytes)
+            html = pypandoc.convert_file(docx_path, "html")
+        finally:
+            if os.path.exists(docx_path):
+                os.unlink(docx_path)
+    return weasyprint.HTML(string=html).write_pdf(font_config=_weasy_fonts())
+
+
+def _soffice_convert(docx_bytes):
+    """Convert DOCX bytes to PDF via headless LibreOffice, or None if it is
+    not installed.
+
+    LibreOffice renders the Word layout (letterhead images included, EMF
+    ones that trip pandoc's LaTeX path) natively, and is much lighter than
+    spinning up a TeX toolchain per letter."""
+    soffice = _soffice_path()
+    if soffice is None:
+        return None
+    base = _scratch_base()
+    docx_path, pdf_path = base + ".docx", base + ".pdf"
+    try:
+        with open(docx_path, "wb") as f:
+            f.write(docx_bytes)
+        subprocess.run(
+            [soffice, "--headless", "--convert-to", "pdf", "--outdir", _scratch_dir(), docx_path],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=120,
+        )
+        with open(pdf_path, "rb") as f:
+            return f.read()
+    finally:
+        for path in (docx_path, pdf_path):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+# --- Bulk generation from a spreadsheet ---
+# Expected spreadsheet columns for bulk mode; one row per student.
+BULK_COLUMNS = ("Name", "Gender", "University", "Project_Topic", "Graduating_Class", "CWA", "Year")
+
+
+def render_bulk(rows):
+    """Render one letter per student row in parallel.
+
+    rows are dicts keyed by BULK_COLUMNS; returns [(file_name, docx_bytes)].
+    docxtpl's lxml serialization releases the GIL, so a thread per core
+    gives near-linear scaling on the render stage, and identical rows
+    still collapse into the build_docx memo."""
+
+    def _render_one(row):
+        context = build_context(
+            row["Name"], row["Gender"], row["University"],
+            row["Project_Topic"], row["Graduating_Class"], row["CWA"], row["Year"],
+        )
+        template_file = template_for(row["Gender"])
+        docx_bytes = build_docx(
+            template_file,
+            template_fingerprint(template_file),
+            tuple(sorted(context.items())),
+        )
+        return docx_filename(row["Name"], row["University"]), docx_bytes
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 2) as pool:
+        return list(pool.map(_render_one, rows))
+
+
+# --- Batch PDF conversion ---
+def _batch_html_to_pdf(pending):
+    """Convert the whole queue with one /batch POST, or None if that path
+    is not available here.
+
+    The Pandoc server cannot produce PDF output — that needs the LaTeX
+    shell-out its server mode refuses — so the batched round trip asks it
+    for HTML and WeasyPrint prints each document in-process. Skipped when
+    LibreOffice is installed (the per-item chain then renders the real
+    Word layout, which the HTML route cannot) or when WeasyPrint/the
+    server is missing."""
+    if _soffice_path() is not None:
+        return None
+    try:
+        import weasyprint
+    except ImportError:
+        return None
+    if _pandoc_server() is None or not _server_ready():
+        return None
+    try:
+        response = _http().post(
+            _PANDOC_SERVER_URL + "/batch",
+            json=[
+                {
+                    "text": base64.b64encode(docx_bytes).decode("ascii"),
+                    "from": "docx",
+                    "to": "html",
+                    "standalone": True,
+                }
+                for _, docx_bytes in pending
+            ],
+            timeout=300,
+        )
+        response.raise_for_status()
+        results = response.json()
+        if len(results) != len(pending):
+            raise ValueError(
+                f"batch answered {len(results)} items for {len(pending)} letters"
+            )
+        return [
+            weasyprint.HTML(string=item["output"]).write_pdf(font_config=_weasy_fonts())
+            for item in results
+        ]
+    except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+        _LOG.warning("Pandoc /batch conversion failed (%s); using the per-item chain.", e)
+        return None
+
+
+def convert_pending_to_pdf(pending):
+    """Convert every queued (name, docx bytes) pair in one warm pass.
+
+    When the batched server route applies, the whole queue goes out as a
+    single /batch POST — one HTTP round trip for N letters. Otherwise
+    each letter walks the per-item memoized converter, which still
+    amortizes engine start-up and skips already-converted content."""
+    pdf_names = [os.path.splitext(docx_name)[0] + ".pdf" for docx_name, _ in pending]
+
+    batch = _batch_html_to_pdf(pending)
+    if batch is not None:
+        return list(zip(pdf_names, batch))
+
+    _LOG.info("Batch route not taken; converting %d letter(s) one by one.", len(pending))
+    return [
+        (pdf_name, save_and_convert_to_pdf(docx_bytes))
+        for pdf_name, (_, docx_bytes) in zip(pdf_names, pending)
+    ]
+
+
+# --- Send email via Gmail SMTP ---
+def send_email_with_gmail(full_name, university, grad_class, cwa, phone, docx_bytes, file_name):
+    """Send the generated letter to your Gmail using SMTP."""
+    sender = st.secrets["SMTP_EMAIL"]
+    recipient = st.secrets["SMTP_EMAIL"]  # send to yourself
+
+    # Create the email
+    msg = EmailMessage()
+    msg["From"] = sender
+    msg["To"] = recipient
+    msg["Subject"] = f"Recommendation Letter Request: {full_name} ({university})"
+    msg.set_content(
+        f"""Dear Dr. Kwegyir,
+
+A new recommendation letter request has been submitted.
+
+Student Details:
+----------------
+Name: {full_name}
+University: {university}
+Graduating Class: {grad_class}
+CWA: {cwa}
+Phone: {phone}
+
+The generated Word document is attached.
+
+Kind regards,
+Automated Recommendation Letter System
+"""
+    )
+
+    # Attach the Word file, unless it is large enough that the base64
+    # inflation would bloat the message — then point at the app instead.
+    if len(docx_bytes) <= _MAX_ATTACHMENT_BYTES:
+        msg.add_attachment(
+            docx_bytes,
+            maintype="application",
+            subtype="vnd.openxmlformats-officedocument.wordprocessingml.document",
+            filename=file_name,
+        )
+    else:
+        msg.set_content(
+            msg.get_content()
+            + f"\n(The document '{file_name}' was too large to attach; "
+            "download it from the submission app.)\n"
+        )
+
+    # Send via the warm Gmail SMTP connection; if the server dropped it
+    # (idle timeout), reconnect once and retry. The envelope is passed
+    # explicitly so send_message doesn't re-derive it from the headers,
+    # and any extra recipients ride the same DATA transaction. The lock
+    # covers the retry too, so two workers can't race clear() and each
+    # open their own replacement connection.
+    with _SMTP_LOCK:
+        try:
+            _smtp().send_message(msg, from_addr=sender, to_addrs=[recipient])
+        except (smtplib.SMTPServerDisconnected, OSError):
+            _smtp.clear()
+            _smtp().send_message(msg, from_addr=sender, to_addrs=[recipient])